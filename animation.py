@@ -0,0 +1,377 @@
+"""
+Multi-frame compression: animated GIF/WebP and multi-page TIFF.
+
+Frames are decoded lazily with ImageSequence. One pass plans the output:
+consecutive frames that are identical (same content hash) or nearly so are
+dropped and their display time is added to the frame before them; every
+other frame records its source index and the bounding box of what changed.
+Only the previous kept frame is in memory during that pass, and later
+passes re-render planned frames one at a time from their index.
+
+Output is animated WebP (libwebp already encodes only the changed
+rectangle of each frame) or an optimized GIF written frame by frame, each
+frame cropped to its changed box. A single knob is searched against the
+total size budget: WebP quality, or GIF palette size, then scale. The
+search runs on a few frames spread over the animation and held in memory,
+extrapolating to the whole; full passes are left for the chosen setting,
+and frames x pixels per pass is capped by scaling down up front.
+"""
+import hashlib
+import io
+import math
+import time
+
+from PIL import GifImagePlugin, Image, ImageChops, ImageOps, ImageSequence, features
+
+DEFAULT_DURATION_MS = 100
+PAGE_DURATION_MS = 1000  # Multi-page documents have no timing of their own
+
+# Per-channel change (0-255) treated as re-encoding noise rather than motion
+NEAR_IDENTICAL_DIFF = 8
+
+GIF_PALETTE_SIZES = (256, 128, 64, 32, 16, 8, 4)
+
+# Frames x pixels one pass over an animation may process; larger inputs are scaled down
+MAX_PASS_PIXELS = 24 * 1000 * 1000
+
+# Frames rendered once and kept for probe encodes, within this much memory
+PROBE_FRAMES = 8
+PROBE_CACHE_BYTES = 24 * 1024 * 1024
+
+# Full WebP encodes per scale; one that fills TARGET_FILL of the budget ships at once
+WEBP_FULL_ENCODES = 3
+TARGET_FILL = 0.8
+
+
+def is_animated(img):
+    return getattr(img, 'n_frames', 1) > 1
+
+
+def default_format():
+    """Animated WebP when this Pillow build supports it, GIF otherwise"""
+    return 'WEBP' if features.check('webp') else 'GIF'
+
+
+class Frame:
+    """A kept frame: full canvas, display time and the box that changed"""
+
+    __slots__ = ('image', 'duration', 'box')
+
+    def __init__(self, image, duration, box):
+        self.image = image
+        self.duration = duration
+        self.box = box
+
+
+class PlannedFrame:
+    """A frame to keep: its index in the source, display time and the box that changed"""
+
+    __slots__ = ('index', 'duration', 'box')
+
+    def __init__(self, index, duration, box):
+        self.index = index
+        self.duration = duration
+        self.box = box
+
+
+def _changed_box(current, previous, tolerance):
+    """
+    Bounding box of pixels that changed by more than `tolerance` in any
+    channel (alpha included), or None when the frames are near-identical.
+    """
+    diff = ImageChops.difference(current, previous)
+    significant = [0] * (tolerance + 1) + [255] * (255 - tolerance)
+    boxes = [band.getbbox() for band in diff.point(significant * 4).split()]
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return None
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def _render(img, size):
+    """The current frame of `img` as RGBA on a canvas of `size`"""
+    frame = img.convert('RGBA')
+    if frame.size != size:
+        # Pages of a different shape are letterboxed onto the canvas
+        frame = ImageOps.pad(frame, size, Image.Resampling.LANCZOS, color=(0, 0, 0, 0))
+    return frame
+
+
+def plan_frames(img, size, max_frames=500, tolerance=NEAR_IDENTICAL_DIFF):
+    """
+    One pass over `img` at `size`: the frames worth keeping, as
+    PlannedFrames. Only the previous kept frame is held in memory.
+    """
+    default_duration = PAGE_DURATION_MS if img.format == 'TIFF' else DEFAULT_DURATION_MS
+    plan = []
+    previous, previous_digest = None, None
+
+    for index, source in enumerate(ImageSequence.Iterator(img)):
+        if index >= max_frames:
+            break
+        frame = _render(source, size)
+        # Read after decoding: some formats (WebP) only set it on load
+        duration = source.info.get('duration') or default_duration
+
+        digest = hashlib.blake2b(frame.tobytes(), digest_size=16).digest()
+        if previous is not None:
+            box = None if digest == previous_digest else _changed_box(frame, previous, tolerance)
+            if box is None:
+                plan[-1].duration += duration
+                continue
+        else:
+            box = (0, 0) + size
+
+        plan.append(PlannedFrame(index, duration, box))
+        previous, previous_digest = frame, digest
+
+    img.seek(0)
+    return plan
+
+
+def _scale_box(box, plan_size, size):
+    """Map a box planned at `plan_size` onto `size`, rounding outwards"""
+    if plan_size == size:
+        return box
+    sx, sy = size[0] / plan_size[0], size[1] / plan_size[1]
+    return (max(0, int(box[0] * sx)), max(0, int(box[1] * sy)),
+            min(size[0], math.ceil(box[2] * sx)), min(size[1], math.ceil(box[3] * sy)))
+
+
+def iter_frames(img, plan, plan_size, size):
+    """Yield the planned frames rendered at `size`, decoding them lazily"""
+    for planned in plan:
+        img.seek(planned.index)
+        yield Frame(_render(img, size), planned.duration, _scale_box(planned.box, plan_size, size))
+
+
+def _probe_frames(img, plan, plan_size, size):
+    """
+    Up to PROBE_FRAMES planned frames spread evenly over the animation,
+    rendered once and kept in memory for the cheap probe encodes.
+    """
+    budget = max(1, PROBE_CACHE_BYTES // (size[0] * size[1] * 4))
+    count = max(1, min(PROBE_FRAMES, budget, len(plan)))
+    step = len(plan) / count
+    picked = [plan[int(i * step)] for i in range(count)]
+    return list(iter_frames(img, picked, plan_size, size))
+
+
+class _FrameStream:
+    """
+    Stand-in for a multi-frame image that Pillow's WebP writer can seek
+    through in order, producing each frame only when it is asked for.
+    """
+
+    def __init__(self, frames, count):
+        self._frames = frames
+        self._index = -1
+        self._current = None
+        self.n_frames = count
+
+    def seek(self, index):
+        while self._index < index:
+            self._current = next(self._frames).image
+            self._index += 1
+
+    def tell(self):
+        return self._index
+
+    def __getattr__(self, name):
+        return getattr(self._current, name)
+
+
+def _encode_webp(frames, durations, loop, buffer, quality):
+    """Encode Frames (a list or a lazy iterator) with `durations` as animated WebP"""
+    frames = iter(frames)
+    first = next(frames)
+    append = [_FrameStream(frames, len(durations) - 1)] if len(durations) > 1 else []
+    buffer.seek(0)
+    # Probes and full encodes use the same method, so their sizes scale together
+    first.image.save(buffer, 'WEBP', save_all=True, append_images=append, duration=durations,
+                     loop=loop, quality=quality, method=4)
+    return buffer.tell()
+
+
+def _flatten(region):
+    """GIF has no partial transparency: composite onto white and quantize later"""
+    background = Image.new('RGB', region.size, (255, 255, 255))
+    background.paste(region, mask=region.getchannel('A'))
+    return background
+
+
+def _encode_gif(frames, loop, buffer, colors, budget):
+    """Stream an optimized GIF; stops early (returning None) once over budget"""
+    buffer.seek(0)
+    first = True
+    for frame in frames:
+        if first:
+            region, offset = frame.image, (0, 0)
+        else:
+            region, offset = frame.image.crop(frame.box), frame.box[:2]
+        paletted = _flatten(region).quantize(colors, dither=Image.Dither.FLOYDSTEINBERG)
+
+        params = {'duration': frame.duration, 'disposal': 1}
+        if first:
+            header, _ = GifImagePlugin.getheader(
+                paletted, info={'loop': loop, 'duration': frame.duration})
+            for chunk in header:
+                buffer.write(chunk)
+            first = False
+        else:
+            params['include_color_table'] = True
+        for chunk in GifImagePlugin.getdata(paletted, offset, **params):
+            buffer.write(chunk)
+
+        if budget is not None and buffer.tell() > budget:
+            return None
+    buffer.write(b';')
+    return buffer.tell()
+
+
+def compress_animation(img, target_bytes, max_dimension=1200, fmt=None, max_frames=500,
+                       max_iterations=6, buffer=None, max_pass_pixels=MAX_PASS_PIXELS):
+    """
+    Compress a multi-frame image to about `target_bytes` in total.
+
+    Frames are planned (deduplicated, boxes found) once. Settings are then
+    searched on a few representative frames held in memory, with the size
+    of the whole animation extrapolated from them; only the chosen setting
+    is encoded over every frame. `max_pass_pixels` caps frames x pixels per
+    pass over the animation by lowering the scale up front.
+
+    Returns (output_image, buffer, size, stats); the encoded animation is
+    the first `size` bytes of `buffer`.
+    """
+    fmt = (fmt or default_format()).upper()
+    buffer = buffer if buffer is not None else io.BytesIO()
+    loop = img.info.get('loop', 0)
+    frames_in = min(getattr(img, 'n_frames', 1), max_frames)
+    stats = {'format': fmt, 'frames_in': getattr(img, 'n_frames', 1), 'encodes': 0,
+             'full_encodes': 0, 'encode_ms': 0.0}
+
+    scale = min(1.0, max_dimension / max(img.size))
+    pass_pixels = frames_in * img.width * img.height * scale * scale
+    if pass_pixels > max_pass_pixels:
+        scale *= math.sqrt(max_pass_pixels / pass_pixels)
+        stats['work_capped'] = True
+
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    plan_size = size
+    plan = plan_frames(img, size, max_frames)
+    stats['frames_out'] = len(plan)
+    probes = _probe_frames(img, plan, plan_size, size)
+    stats['probe_frames'] = len(probes)
+    extrapolate = len(plan) / len(probes)
+    durations = [frame.duration for frame in plan]
+    probe_durations = [frame.duration for frame in probes]
+
+    def timed(encode, full, *args):
+        start = time.perf_counter()
+        size_out = encode(*args)
+        stats['encode_ms'] += (time.perf_counter() - start) * 1000
+        stats['encodes'] += 1
+        stats['full_encodes'] += full
+        return size_out
+
+    def full_webp(out, quality):
+        return timed(_encode_webp, True, iter_frames(img, plan, plan_size, size), durations,
+                     loop, out, quality)
+
+    probe_buffer, spare = io.BytesIO(), None
+    # Probe estimate -> real size. Probe frames are further apart than real
+    # neighbours, so libwebp finds less to reuse between them; every full
+    # encode corrects this, and the correction carries over between scales
+    calibration, calibrated = 1.0, False
+    for _ in range(4):
+        if fmt == 'WEBP':
+            probe_sizes = {}
+
+            def estimate(quality):
+                if quality not in probe_sizes:
+                    probe_sizes[quality] = timed(_encode_webp, False, probes, probe_durations,
+                                                 loop, probe_buffer, quality)
+                return probe_sizes[quality] * extrapolate * calibration
+
+            low, high, fitted, best = 0, 100, None, None
+            for _ in range(WEBP_FULL_ENCODES):
+                # Binary search quality on the probe frames
+                lo, hi, quality = low, high, None
+                for _ in range(max_iterations):
+                    if lo > hi:
+                        break
+                    mid = (lo + hi) // 2
+                    estimated = estimate(mid)
+                    if estimated <= target_bytes:
+                        quality, lo = mid, mid + 1
+                    else:
+                        hi = mid - 1
+                    best = estimated if best is None else min(best, estimated)
+                if quality is None:
+                    if calibrated or low > 0:
+                        break
+                    # Never measured: the probes may overstate, so try the floor for real
+                    quality = 0
+
+                out = spare if fitted and fitted[0] is buffer else buffer
+                encoded = full_webp(out, quality)
+                calibration *= encoded / estimate(quality)
+                calibrated = True
+                best = min(best, encoded)
+                if encoded <= target_bytes:
+                    fitted = (out, encoded, quality)
+                    if encoded >= target_bytes * TARGET_FILL or quality >= high:
+                        break
+                    # Well under budget: search again above it, keeping this one
+                    low = quality + 1
+                    spare = spare if spare is not None else io.BytesIO()
+                else:
+                    high = quality - 1
+                    if fitted:
+                        break
+                if low > high:
+                    break
+
+            if fitted:
+                out, encoded, stats['quality'] = fitted
+                return _result(img, size, out, encoded, stats)
+        else:
+            # Largest palette whose estimate fits. Probe frames keep their
+            # planned boxes, so each costs what it will in the real GIF
+            best = None
+            for colors in GIF_PALETTE_SIZES:
+                probe = timed(_encode_gif, False, probes, loop, io.BytesIO(), colors, None)
+                estimated = probe * extrapolate
+                best = estimated if best is None else min(best, estimated)
+                if estimated > target_bytes * 1.1:
+                    continue
+                # An over-budget full encode is abandoned mid-stream
+                encoded = timed(_encode_gif, True, iter_frames(img, plan, plan_size, size),
+                                loop, buffer, colors, target_bytes)
+                if encoded is not None:
+                    stats['colors'] = colors
+                    return _result(img, size, buffer, encoded, stats)
+
+        # Even the cheapest setting is too big: shrink every frame and retry
+        scale *= max(0.3, math.sqrt(target_bytes / max(best, 1)) * 0.9)
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        probes = [Frame(frame.image.resize(size, Image.Resampling.LANCZOS), frame.duration,
+                        _scale_box(frame.box, probes[0].image.size, size)) for frame in probes]
+
+    # Give up on the budget; ship the smallest setting at the final scale
+    if fmt == 'WEBP':
+        encoded = full_webp(buffer, 0)
+    else:
+        encoded = timed(_encode_gif, True, iter_frames(img, plan, plan_size, size),
+                        loop, buffer, GIF_PALETTE_SIZES[-1], None)
+    return _result(img, size, buffer, encoded, stats)
+
+
+def _result(img, size, buffer, encoded, stats):
+    img.seek(0)
+    stats['encode_ms'] = round(stats['encode_ms'], 1)
+    # Opening is lazy: only the header of the output is parsed
+    with buffer.getbuffer() as view:
+        output = Image.open(io.BytesIO(view[:encoded]))
+    return output, buffer, encoded, stats
@@ -0,0 +1,178 @@
+"""
+Streaming ZIP archives of stored results.
+
+Entries are stored (method 0): JPEG, WebP and GIF data is already entropy
+coded and does not deflate. Because nothing is recompressed, every header
+has a fixed size and the total length and every entry's offset follow from
+the file sizes alone, before a single byte of content is read. That gives
+a Content-Length up front and lets any byte range be served on its own.
+
+CRC-32s are computed while the data streams out, so the first bytes go out
+before the last entry is read, and each local header defers its CRC to a
+data descriptor after the data (general purpose flag bit 3). A range that
+starts past an entry, or that skips part of one, reads that entry once in
+chunks to get its CRC before writing a descriptor or the central
+directory. Memory use is one chunk whatever the archive size.
+
+Every entry is dated at the DOS epoch (1980-01-01), as zipfile.ZipInfo does
+by default: the stored files' mtimes record their last access (see
+storage.py), and letting them into the headers would change the bytes
+between a download and its resumption.
+"""
+import hashlib
+import os
+import struct
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+# Sizes stay below 4 GiB, so plain (non-ZIP64) records are enough
+MAX_ARCHIVE_BYTES = 0xFFFFFFFF
+
+_FLAGS = 0x0808  # Bit 3: CRC in data descriptor; bit 11: UTF-8 names
+_VERSION = 20
+_DOS_TIME, _DOS_DATE = 0, (1 << 5) | 1  # 1980-01-01 00:00
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+
+
+class _Entry:
+    __slots__ = ('name', 'file', 'size', 'identity', 'offset', 'crc')
+
+    def __init__(self, name, file):
+        self.name = name.encode('utf-8')
+        self.file = file
+        st = os.fstat(file.fileno())
+        self.size = st.st_size
+        # Results are replaced by rename, never rewritten, so the inode pins the content
+        self.identity = (st.st_dev, st.st_ino)
+        self.offset = 0
+        self.crc = None
+
+
+class ZipStream:
+    """
+    A stored ZIP of already-open files, readable as byte ranges.
+
+    `files` is a list of (archive_name, binary file object). The handles
+    are owned by the stream and closed by close(); holding them open pins
+    the content even if the files are replaced or evicted meanwhile.
+    """
+
+    def __init__(self, files):
+        self.entries = [_Entry(name, file) for name, file in files]
+        self._segments = []  # (offset, length, render(skip, count) -> iterator of bytes)
+        # Identifies these exact bytes, so a resumed download can detect a change
+        digest = hashlib.blake2b(digest_size=12)
+        for entry in self.entries:
+            digest.update(b'%s\0%d\0%d\0%d\0' % ((entry.name, entry.size) + entry.identity))
+        self.etag = digest.hexdigest()
+
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            header = self._local_header(entry)
+            offset = self._add(offset, len(header), self._constant(header))
+            offset = self._add(offset, entry.size, self._data(entry))
+            offset = self._add(offset, _DATA_DESCRIPTOR.size, self._descriptor(entry))
+
+        self.directory_offset = offset
+        directory_size = sum(_CENTRAL_HEADER.size + len(entry.name) for entry in self.entries)
+        offset = self._add(offset, directory_size, self._directory)
+        offset = self._add(offset, _END_OF_CENTRAL_DIRECTORY.size, self._constant(
+            _END_OF_CENTRAL_DIRECTORY.pack(0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                           directory_size, self.directory_offset, 0)))
+        self.size = offset
+        if self.size > MAX_ARCHIVE_BYTES or len(self.entries) > 0xFFFF:
+            self.close()
+            raise ValueError('archive too large')
+
+    def _add(self, offset, length, render):
+        self._segments.append((offset, length, render))
+        return offset + length
+
+    # Records -------------------------------------------------------------
+
+    @staticmethod
+    def _local_header(entry):
+        # Sizes are known up front; only the CRC waits for the descriptor
+        return _LOCAL_HEADER.pack(0x04034b50, _VERSION, _FLAGS, 0, _DOS_TIME, _DOS_DATE,
+                                  0, entry.size, entry.size, len(entry.name), 0) + entry.name
+
+    @staticmethod
+    def _constant(data):
+        def render(skip, count):
+            yield data[skip:skip + count]
+        return render
+
+    def _descriptor(self, entry):
+        def render(skip, count):
+            crc = self._crc(entry)
+            yield _DATA_DESCRIPTOR.pack(0x08074b50, crc, entry.size, entry.size)[skip:skip + count]
+        return render
+
+    def _directory(self, skip, count):
+        position = 0
+        for entry in self.entries:
+            length = _CENTRAL_HEADER.size + len(entry.name)
+            if position + length > skip and count > 0:
+                record = _CENTRAL_HEADER.pack(
+                    0x02014b50, _VERSION, _VERSION, _FLAGS, 0, _DOS_TIME, _DOS_DATE,
+                    self._crc(entry), entry.size, entry.size, len(entry.name), 0, 0, 0, 0,
+                    0o100644 << 16, entry.offset) + entry.name
+                start = max(0, skip - position)
+                piece = record[start:start + count]
+                count -= len(piece)
+                yield piece
+            position += length
+
+    def _data(self, entry):
+        def render(skip, count):
+            # The CRC can ride along only when the whole entry streams from byte 0
+            crc = 0 if entry.crc is None and skip == 0 and count == entry.size else None
+            entry.file.seek(skip)
+            while count > 0:
+                chunk = entry.file.read(min(CHUNK_SIZE, count))
+                if not chunk:
+                    raise IOError(f'{entry.name.decode()} shrank while being archived')
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                count -= len(chunk)
+                yield chunk
+            if crc is not None:
+                entry.crc = crc
+        return render
+
+    def _crc(self, entry):
+        """CRC-32 of an entry, reading it in chunks if it was not streamed whole"""
+        if entry.crc is None:
+            crc = 0
+            entry.file.seek(0)
+            for chunk in iter(lambda: entry.file.read(CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+            entry.crc = crc
+        return entry.crc
+
+    # Output --------------------------------------------------------------
+
+    def iter_range(self, start=0, stop=None):
+        """Yield the bytes of the archive from `start` up to (not including) `stop`"""
+        stop = self.size if stop is None else min(stop, self.size)
+        for offset, length, render in self._segments:
+            end = offset + length
+            if end <= start or length == 0:
+                continue
+            if offset >= stop:
+                break
+            skip = max(0, start - offset)
+            count = min(end, stop) - offset - skip
+            for piece in render(skip, count):
+                if piece:
+                    yield piece
+
+    def close(self):
+        for entry in self.entries:
+            entry.file.close()
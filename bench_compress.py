@@ -0,0 +1,76 @@
+"""
+Benchmark the compression engine without the web layer.
+
+    python bench_compress.py image1.jpg VEDRA.jpg --targets 5 15 60 --repeat 5
+
+For every image/target pair this reports wall time, encodes (of which
+thumbnail encodes spent picking the encoder profile) and buffer
+allocations per request, the peak Python-heap memory (tracemalloc) used
+while compressing, the time per baseline probe, the encoder profile picked,
+and the bytes optimize/progressive saved over the probe at equal quality.
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+from compressor import Compressor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def bench(compressor, data, target_kb, repeat):
+    """Compress `data` `repeat` times and average the per-request numbers"""
+    compressor.compress(data, target_kb)  # Warm-up: allocates this thread's scratch buffer
+
+    totals = {'encodes': 0, 'tune_encodes': 0, 'buffer_allocs': 0, 'probe_ms': 0.0,
+              'probe_encodes': 0, 'optimize_saved_bytes': 0}
+    elapsed = 0.0
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = compressor.compress(data, target_kb)
+        elapsed += time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        for key in totals:
+            totals[key] += result.stats.get(key, 0)
+
+    return {
+        'ms': elapsed / repeat * 1000,
+        'encodes': totals['encodes'] / repeat,
+        'tune_encodes': totals['tune_encodes'] / repeat,
+        'buffer_allocs': totals['buffer_allocs'] / repeat,
+        'peak_kb': peak / 1024,
+        'size_kb': result.size_kb,
+        'ms_per_probe': totals['probe_ms'] / max(1, totals['probe_encodes']),
+        'saved_bytes': totals['optimize_saved_bytes'] / repeat,
+        'profile': result.stats.get('profile', '-'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Compressor.compress')
+    parser.add_argument('images', nargs='*', default=[os.path.join(HERE, 'image1.jpg')])
+    parser.add_argument('--targets', nargs='*', type=int, default=[5, 15, 60])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    compressor = Compressor()
+    print(f"{'image':<16} {'target':>6} {'ms/req':>8} {'encodes':>8} {'tuning':>7} "
+          f"{'allocs':>7} {'peak KB':>8} {'out KB':>7} {'ms/probe':>9} {'saved B':>8}  profile")
+    for path in args.images:
+        with open(path, 'rb') as f:
+            data = f.read()
+        for target_kb in args.targets:
+            stats = bench(compressor, data, target_kb, args.repeat)
+            print(f"{os.path.basename(path)[:16]:<16} {target_kb:>6} {stats['ms']:>8.1f} "
+                  f"{stats['encodes']:>8.1f} {stats['tune_encodes']:>7.1f} {stats['buffer_allocs']:>7.1f} "
+                  f"{stats['peak_kb']:>8.0f} {stats['size_kb']:>7.1f} "
+                  f"{stats['ms_per_probe']:>9.2f} {stats['saved_bytes']:>8.0f}  {stats['profile']}")
+
+
+if __name__ == '__main__':
+    main()
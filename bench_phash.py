@@ -0,0 +1,157 @@
+"""
+Benchmark the perceptual-hash index at production size.
+
+    python bench_phash.py image1.jpg image2.jpg VEDRA.jpg --entries 1000000
+
+The index is filled with random fingerprints plus the given images, then
+queried with near-duplicates of those images (JPEG re-encodes, a PNG
+re-save, downscales, a small brightness change) and with unrelated images
+(mirrored copies, synthetic gradients and noise). Reports the hit rate on
+the near-duplicates, the false-match rate on the rest, which matches would
+be reused (only pixel-identical ones: the PNG re-save), lookup latency, the
+cost of hashing an upload, and the index's memory, merge-save and load time.
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from PIL import Image, ImageEnhance, ImageOps
+
+from phash import ImageHash, PerceptualIndex, image_hash, params_key, pixel_digest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def encode(img, fmt='JPEG', **options):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def near_duplicates(data):
+    """Copies of an upload as they tend to come back"""
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    half = img.resize((img.width // 2, img.height // 2), Image.Resampling.LANCZOS)
+    return {
+        'jpeg q95': encode(img, quality=95),
+        'jpeg q75': encode(img, quality=75),
+        'jpeg q50': encode(img, quality=50),
+        'png': encode(img, 'PNG'),
+        'scale 0.5': encode(half, quality=85),
+        'brighter 3%': encode(ImageEnhance.Brightness(img).enhance(1.03), quality=85),
+    }
+
+
+def unrelated(data, seed):
+    """Images that must not match: mirrored copies and synthetic content"""
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').resize(img.size).convert('RGB')
+    noise = Image.effect_noise(img.size, rng.uniform(20, 80)).convert('RGB')
+    return {
+        'mirrored': encode(ImageOps.mirror(img), quality=85),
+        'flipped': encode(ImageOps.flip(img), quality=85),
+        'gradient': encode(gradient, quality=85),
+        'noise': encode(noise, quality=85),
+    }
+
+
+def pixels_of(data):
+    return pixel_digest(Image.open(io.BytesIO(data)))
+
+
+def fill(index, count, key, seed=0):
+    """Add `count` random fingerprints under `key`"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        hashes = ImageHash(rng.getrandbits(64), rng.getrandbits(64), rng.uniform(0.5, 2.0),
+                           (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        index.add(hashes, key, rng.randrange(10, 96), 'standard')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PerceptualIndex')
+    parser.add_argument('images', nargs='*', default=[os.path.join(HERE, name) for name in
+                                                      ('image1.jpg', 'image2.jpg', 'VEDRA.jpg')])
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20, help='lookups per query for latency')
+    args = parser.parse_args()
+
+    # One key for everything: the worst case, every entry is a candidate for the scan
+    key = params_key(15)
+    index = PerceptualIndex(capacity=args.entries + len(args.images), save_every=0)
+    start = time.perf_counter()
+    fill(index, args.entries, key)
+    print(f"filled {len(index):,} entries in {time.perf_counter() - start:.1f}s, "
+          f"{index.metrics()['bytes'] / 1e6:.1f} MB")
+
+    uploads = {}
+    rows = {}
+    hash_ms = []
+    for path in args.images:
+        with open(path, 'rb') as f:
+            uploads[os.path.basename(path)] = f.read()
+    for name, data in uploads.items():
+        start = time.perf_counter()
+        hashes = image_hash(data)
+        hash_ms.append((time.perf_counter() - start) * 1000)
+        index.add(hashes, key, 75, 'standard', name, pixels=pixels_of(data))
+        rows[len(index) - 1] = name  # Matches name a stored result only when reusable
+
+    latencies = []
+    hits = tries = reused = false_matches = negatives = 0
+    print(f"\n{'query':<32} {'match':<18} {'bits':>4}")
+    for seed, (name, data) in enumerate(uploads.items()):
+        queries = [(f'{name} {label}', body, True) for label, body in near_duplicates(data).items()]
+        queries += [(f'{name} {label}', body, False) for label, body in unrelated(data, seed).items()]
+        for label, body, expected in queries:
+            start = time.perf_counter()
+            hashes = image_hash(body)
+            hash_ms.append((time.perf_counter() - start) * 1000)
+            pixels = pixels_of(body)
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                match = index.lookup(hashes, key, pixels=pixels)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            found = match is not None and rows.get(match.row) == name
+            if expected:
+                tries += 1
+                hits += found
+                reused += found and match.reusable
+            else:
+                negatives += 1
+                false_matches += match is not None
+            shown = ('-' if match is None else
+                     f"{rows.get(match.row, 'random')}{' (reuse)' if match.reusable else ''}")
+            print(f"{label[:32]:<32} {shown[:18]:<18} {match.distance if match else '':>4}")
+
+    latencies.sort()
+    print(f"\nhit rate on near-duplicates: {hits}/{tries} ({hits / tries:.0%})")
+    print(f"reusable (pixel-identical):  {reused}/{tries}")
+    print(f"false matches on unrelated:  {false_matches}/{negatives}")
+    print(f"lookup at {len(index):,} entries: p50 {latencies[len(latencies) // 2]:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms, "
+          f"mean {statistics.mean(latencies):.2f} ms")
+    print(f"hashing an upload: median {statistics.median(hash_ms):.1f} ms")
+
+    with tempfile.TemporaryDirectory() as directory:
+        index.path = os.path.join(directory, 'index.npz')
+        index._write()  # The file as the workers share it
+        # A save merges what this process added into the file: read, append, replace
+        index.add(ImageHash(1, 2, 1.0, (0, 0, 0)), key, 75, 'standard')
+        start = time.perf_counter()
+        index.save()
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = PerceptualIndex(index.path, capacity=index.capacity)
+        print(f"merge-save {saved * 1000:.0f} ms, load {(time.perf_counter() - start) * 1000:.0f} ms, "
+              f"{os.path.getsize(index.path) / 1e6:.1f} MB on disk, {len(loaded):,} entries")
+
+
+if __name__ == '__main__':
+    main()
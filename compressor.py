@@ -0,0 +1,442 @@
+"""
+Image compression engine, usable without Flask.
+
+    from compressor import Compressor
+
+    compressor = Compressor(target_kb=15)
+    result = compressor.compress(open('photo.jpg', 'rb').read())
+    result.data                                   # read-only memoryview of the JPEG
+    compressor.compress_to_file('photo.jpg', 'small.jpg')
+    n = compressor.compress_into('photo.jpg', my_bytearray)
+
+Importing this module only pulls in Pillow; app.py is a thin web adapter on top.
+"""
+import base64
+import functools
+import io
+import math
+import os
+import threading
+import time
+
+from PIL import Image, ImageChops, ImageStat
+
+from animation import compress_animation, is_animated
+
+PLACEHOLDER_PREVIEW = "data:image/svg+xml;base64," + base64.b64encode(
+    '<svg xmlns="http://www.w3.org/2000/svg" width="300" height="200" viewBox="0 0 300 200"><rect width="300" height="200" fill="#f0f0f0"/><text x="150" y="100" text-anchor="middle" fill="#666">Preview</text></svg>'.encode()
+).decode()
+
+
+class CompressionResult:
+    """
+    Output of a single compression: the final image and its encoded bytes.
+
+    `data` is a read-only memoryview over the buffer the winning encode was
+    written into, so handing the result onward never copies it.
+    """
+
+    mime_type = 'image/jpeg'
+    extension = '.jpg'
+
+    def __init__(self, image, data, stats=None, mime_type=None, extension=None):
+        self.image = image
+        self.data = data
+        self.stats = stats or {}
+        if mime_type:
+            self.mime_type = mime_type
+        if extension:
+            self.extension = extension
+
+    @property
+    def size_bytes(self):
+        return self.data.nbytes
+
+    @property
+    def size_kb(self):
+        return self.data.nbytes / 1024
+
+    @property
+    def dimensions(self):
+        return self.image.size
+
+
+# Perceptually tuned quantization tables (N. Robidoux, as shipped with
+# ImageMagick and mozjpeg): gentler on low frequencies than the Annex K
+# tables, so small budgets keep smooth gradients instead of blocking.
+PERCEPTUAL_QTABLE = (
+    16, 16, 16, 18, 25, 37, 56, 85,
+    16, 17, 20, 27, 34, 40, 53, 75,
+    16, 20, 24, 31, 43, 62, 91, 135,
+    18, 27, 31, 40, 53, 74, 106, 156,
+    25, 34, 43, 53, 69, 94, 131, 189,
+    37, 40, 62, 74, 94, 124, 169, 238,
+    56, 53, 91, 106, 131, 169, 226, 311,
+    85, 75, 135, 156, 189, 238, 311, 418,
+)
+
+# Encoder settings searched per image. subsampling: 2 = 4:2:0, 0 = 4:4:4
+ENCODER_PROFILES = {
+    'standard': {'subsampling': 2, 'qtable': None},
+    'chroma444': {'subsampling': 0, 'qtable': None},
+    'perceptual': {'subsampling': 2, 'qtable': PERCEPTUAL_QTABLE},
+}
+
+# Approximate fixed cost of a JPEG (markers, tables) that doesn't scale with pixels
+JPEG_OVERHEAD_BYTES = 700
+
+# Quality search window (+/-) around a hint from a near-duplicate image
+HINT_WINDOW = 6
+
+
+@functools.lru_cache(maxsize=None)
+def scaled_qtable(qtable, quality):
+    """Scale a quantization table by IJG quality (1-100), clamped to baseline range"""
+    scale = 5000 // quality if quality < 50 else 200 - 2 * quality
+    return tuple(min(255, max(1, (value * scale + 50) // 100)) for value in qtable)
+
+
+class Compressor:
+    """
+    Reusable compression settings plus per-thread scratch buffers.
+
+    One instance can be shared between threads. Probe encodes are written
+    into a per-thread scratch buffer that is rewound, never truncated, and
+    measured with tell(); whenever a probe fits the target its buffer is kept
+    and swapped out.
+
+    Probes are fast baseline encodes. optimize/progressive shrink the output
+    by a fairly stable ratio, so the search aims at target / ratio and only
+    the final encode pays for them. The ratio is a fixed setting, not learned
+    from earlier requests, so one image never changes another's output; an
+    image that gains less than assumed is re-searched with final encodes.
+    """
+
+    def __init__(self, target_kb=15, max_dimension=1200, min_quality=10,
+                 max_quality=95, max_iterations=10, buffer_size=256 * 1024,
+                 crop_aspect=None, crop_zoom=1.0, profiles=None, tune_encoder=True,
+                 optimize_ratio=0.9, animate=True, animation_format=None, max_frames=500):
+        self.target_kb = target_kb
+        self.crop_aspect = crop_aspect
+        self.crop_zoom = crop_zoom
+        self.max_dimension = max_dimension
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.max_iterations = max_iterations
+        self.buffer_size = buffer_size
+        self.profiles = profiles or list(ENCODER_PROFILES)
+        self.tune_encoder = tune_encoder
+        self.optimize_ratio = optimize_ratio
+        self.animate = animate
+        self.animation_format = animation_format
+        self.max_frames = max_frames
+        self._local = threading.local()
+
+    def _new_buffer(self, stats, size=None):
+        """Allocate an encode buffer, sized up front so encodes rarely regrow it"""
+        stats['buffer_allocs'] += 1
+        buffer = io.BytesIO()
+        size = self.buffer_size if size is None else size
+        if size:
+            buffer.write(bytes(size))
+        return buffer
+
+    def _take_scratch(self, stats):
+        """Detach this thread's scratch buffer (allocating one on first use)"""
+        buffer = getattr(self._local, 'buffer', None)
+        self._local.buffer = None
+        return buffer if buffer is not None else self._new_buffer(stats)
+
+    def _encode(self, img, buffer, quality, stats, profile='standard', final=False):
+        """
+        Encode from the start of `buffer` and return the encoded length.
+
+        Probes are plain baseline encodes; only `final` encodes pay for
+        Huffman optimization and progressive scans.
+        """
+        settings = ENCODER_PROFILES[profile]
+        options = {'subsampling': settings['subsampling']}
+        if settings['qtable']:
+            table = list(scaled_qtable(settings['qtable'], quality))
+            options['qtables'] = [table, table]
+        else:
+            options['quality'] = quality
+        if final:
+            options.update(optimize=True, progressive=True)
+
+        buffer.seek(0)
+        start = time.perf_counter()
+        img.save(buffer, 'JPEG', **options)
+        elapsed = time.perf_counter() - start
+
+        stats['encodes'] += 1
+        kind = 'final' if final else 'probe'
+        stats[f'{kind}_encodes'] += 1
+        stats[f'{kind}_ms'] += elapsed * 1000
+        return buffer.tell()
+
+    def _search(self, img, buffer, budget, stats, profile, low=None, high=None, final=False,
+                spare=None):
+        """
+        Binary search for the highest quality whose encode fits `budget`
+        (baseline probes, or optimized encodes with `final`). The first fit
+        is swapped into `spare` when given, else into a new buffer.
+
+        Returns (quality, size, best_buffer, spare_buffer); the first three
+        are None when nothing fit.
+        """
+        best, best_size, best_quality = None, None, None
+        low = self.min_quality if low is None else low
+        high = self.max_quality if high is None else high
+        scratch = buffer
+
+        for _ in range(self.max_iterations):
+            if low > high:
+                break  # Converged; further probes would repeat a known quality
+            mid = (low + high) // 2
+            size = self._encode(img, scratch, mid, stats, profile, final=final)
+
+            if size <= budget:
+                best_quality = mid
+                low = mid + 1  # Try higher quality
+                if best is None:
+                    best = spare if spare is not None else self._new_buffer(stats)
+                best, scratch, best_size = scratch, best, size
+            else:
+                high = mid - 1  # Try lower quality
+
+        return best_quality, best_size, best, scratch
+
+    def _choose_profile(self, img, target_bytes, stats):
+        """
+        Pick the encoder profile that reproduces a thumbnail most faithfully
+        at a proportionally scaled budget.
+        """
+        if not self.tune_encoder or len(self.profiles) == 1:
+            return self.profiles[0]
+
+        start = time.perf_counter()
+        scale = min(1.0, 256 / max(img.size))
+        if scale < 1.0:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            thumb = img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        else:
+            thumb = img
+        pixel_ratio = thumb.width * thumb.height / (img.width * img.height)
+        budget = JPEG_OVERHEAD_BYTES + max(0, target_bytes - JPEG_OVERHEAD_BYTES) * pixel_ratio
+
+        tune_stats = {'encodes': 0, 'buffer_allocs': 0, 'probe_encodes': 0,
+                      'probe_ms': 0.0, 'final_encodes': 0, 'final_ms': 0.0}
+        # Thumbnail encodes are small: two growable buffers, passed back and forth
+        buffer, spare = self._new_buffer(tune_stats, 0), None
+        chosen, chosen_error = self.profiles[0], None
+        for profile in self.profiles:
+            quality, size, best, buffer = self._search(
+                thumb, buffer, budget, tune_stats, profile, spare=spare)
+            if quality is None:
+                continue
+            decoded = Image.open(io.BytesIO(best.getbuffer()[:size]))
+            decoded = decoded.convert(thumb.mode)
+            error = sum(ImageStat.Stat(ImageChops.difference(thumb, decoded)).rms)
+            if chosen_error is None or error < chosen_error * 0.98:
+                chosen, chosen_error = profile, error
+            spare = best
+
+        # Tuning is part of the request's work: count it in the totals too
+        stats['encodes'] += tune_stats['encodes']
+        stats['buffer_allocs'] += tune_stats['buffer_allocs']
+        stats['tune_encodes'] = tune_stats['encodes']
+        stats['tune_ms'] = (time.perf_counter() - start) * 1000
+        return chosen
+
+    def compress(self, source, target_kb=None, crop_aspect=None, quality_hint=None,
+                 profile_hint=None):
+        """
+        Compress `source` (bytes, path, file object or PIL image) to about target_kb.
+
+        With a crop aspect ratio ('1:1', '16:9', 1.5, ...) the image is first
+        cropped around its most salient region, so a tiny budget is spent on
+        the subject instead of on a globally downscaled frame.
+
+        quality_hint/profile_hint come from an earlier compression of a near
+        duplicate: the profile is used without tuning and the quality search
+        starts in a narrow window around the hint.
+        """
+        img = source if isinstance(source, Image.Image) else open_image(source)
+        target_kb = self.target_kb if target_kb is None else target_kb
+        crop_aspect = self.crop_aspect if crop_aspect is None else crop_aspect
+        target_bytes = target_kb * 1024
+        stats = {'encodes': 0, 'buffer_allocs': 0, 'probe_encodes': 0, 'probe_ms': 0.0,
+                 'final_encodes': 0, 'final_ms': 0.0, 'tune_encodes': 0, 'tune_ms': 0.0}
+
+        # Animated GIF/WebP and multi-page TIFF keep their frames
+        if self.animate and is_animated(img):
+            return self._compress_frames(img, target_bytes, stats)
+
+        # Format check
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGB')
+
+        # Step 0: Optional smart crop (NumPy is only imported when asked for)
+        if crop_aspect:
+            from smartcrop import parse_aspect, smart_crop
+            aspect = parse_aspect(crop_aspect)
+            if aspect:
+                img = smart_crop(img, aspect, self.crop_zoom)
+
+        # Original dimensions
+        orig_width, orig_height = img.size
+
+        # Step 1: Start with reasonable dimensions
+        if max(orig_width, orig_height) > self.max_dimension:
+            ratio = self.max_dimension / max(orig_width, orig_height)
+            new_width = int(orig_width * ratio)
+            new_height = int(orig_height * ratio)
+            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+        # Step 2: Pick encoder settings for this image, then binary search
+        # quality with cheap baseline probes against the corrected budget
+        if profile_hint in self.profiles:
+            profile = profile_hint
+        else:
+            profile = self._choose_profile(img, target_bytes, stats)
+        ratio = self.optimize_ratio
+        low, high = self.min_quality, self.max_quality
+        if quality_hint is not None:
+            stats['seeded'] = True
+            low = max(self.min_quality, quality_hint - HINT_WINDOW)
+            high = min(self.max_quality, quality_hint + HINT_WINDOW)
+        best_quality, best_size, best, scratch = self._search(
+            img, self._take_scratch(stats), target_bytes / ratio, stats, profile, low, high)
+        if best is None and low > self.min_quality:
+            # The hint was too optimistic for this copy: search below the window
+            best_quality, best_size, best, scratch = self._search(
+                img, scratch, target_bytes / ratio, stats, profile, high=low - 1)
+
+        if best is not None:
+            # Step 3: One optimized/progressive encode at the chosen quality
+            final_size = self._encode(img, scratch, best_quality, stats, profile, final=True)
+            stats['optimize_saved_bytes'] = best_size - final_size
+            if final_size <= target_bytes:
+                best, scratch, best_size = scratch, best, final_size
+            elif best_size > target_bytes and best_quality > self.min_quality:
+                # This image gains less from optimize than assumed (a probe
+                # that fits anyway is shipped as is): search the lower
+                # qualities with final encodes against the real target
+                quality, size, found, scratch = self._search(
+                    img, scratch, target_bytes, stats, profile, high=best_quality - 1, final=True)
+                if found is not None:
+                    best, best_size, best_quality = found, size, quality
+        else:
+            # No probe fit the corrected budget, but the smallest optimized
+            # encode may still fit the real one before resorting to step 4
+            best, scratch = scratch, None
+            best_quality = self.min_quality
+            best_size = self._encode(img, best, best_quality, stats, profile, final=True)
+            if best_size > target_bytes:
+                # Measure the optimized size at default quality for step 4
+                best_quality = 85
+                best_size = self._encode(img, best, best_quality, stats, profile, final=True)
+
+        # Step 4: If still too large, reduce dimensions
+        if best_size > target_bytes:
+            reduction_factor = math.sqrt(target_bytes / best_size)
+            new_width = int(img.width * reduction_factor * 0.9)
+            new_height = int(img.height * reduction_factor * 0.9)
+            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            best_quality = 75
+            best_size = self._encode(img, best, best_quality, stats, profile, final=True)
+            stats['downscaled'] = True
+
+        stats.update(profile=profile, quality=best_quality, optimize_ratio=round(ratio, 3))
+        if stats['probe_encodes']:
+            stats['ms_per_probe'] = stats['probe_ms'] / stats['probe_encodes']
+
+        # `best` now belongs to the result; the other buffer stays with the thread
+        self._local.buffer = scratch
+        data = best.getbuffer()[:int(best_size)].toreadonly()
+        return CompressionResult(img, data, stats)
+
+    def _compress_frames(self, img, target_bytes, stats):
+        """Compress every frame of a multi-frame image against one total budget"""
+        buffer = self._take_scratch(stats)
+        output, buffer, size, frame_stats = compress_animation(
+            img, target_bytes, self.max_dimension, self.animation_format,
+            self.max_frames, buffer=buffer)
+        stats.update(frame_stats)
+        fmt = frame_stats['format']
+        data = buffer.getbuffer()[:size].toreadonly()
+        return CompressionResult(output, data, stats,
+                                 mime_type=f'image/{fmt.lower()}', extension=f'.{fmt.lower()}')
+
+    def compress_to_bytes(self, source, target_kb=None, crop_aspect=None):
+        """Compress and return the encoded bytes as an independent bytes object"""
+        return bytes(self.compress(source, target_kb, crop_aspect).data)
+
+    def compress_to_file(self, source, destination, target_kb=None, crop_aspect=None):
+        """Compress and write to a path or writable binary file object"""
+        result = self.compress(source, target_kb, crop_aspect)
+        if hasattr(destination, 'write'):
+            destination.write(result.data)
+        else:
+            with open(destination, 'wb') as f:
+                f.write(result.data)
+        return result
+
+    def compress_into(self, source, out, target_kb=None, crop_aspect=None):
+        """
+        Compress into a caller-supplied writable buffer (bytearray, memoryview,
+        mmap, ...) and return the number of bytes written.
+        """
+        data = self.compress(source, target_kb, crop_aspect).data
+        with memoryview(out) as view:
+            if view.readonly:
+                raise TypeError('output buffer is read-only')
+            if view.nbytes < data.nbytes:
+                raise ValueError(f'output buffer too small: need {data.nbytes} bytes, got {view.nbytes}')
+            view.cast('B')[:data.nbytes] = data
+        return data.nbytes
+
+
+def open_image(source):
+    """Open and verify an image from bytes, a path or a binary file object"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            data = f.read()
+    else:
+        data = source.read()
+
+    img = Image.open(io.BytesIO(data))
+    img.verify()  # Verify it's an image
+    return Image.open(io.BytesIO(data))  # Re-open after verify
+
+
+def get_image_preview(img_data, max_size=300):
+    """Create a base64 preview of image"""
+    try:
+        img = Image.open(io.BytesIO(img_data))
+        img.thumbnail((max_size, max_size))
+
+        buffer = io.BytesIO()
+        # Convert to RGB if needed
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGB')
+        img.save(buffer, format='JPEG', quality=70)
+
+        return f"data:image/jpeg;base64,{base64.b64encode(buffer.getbuffer()).decode()}"
+    except Exception:
+        # Return a placeholder if preview generation fails
+        return PLACEHOLDER_PREVIEW
+
+
+_default_compressor = Compressor()
+
+
+def smart_compress_to_target(img, target_kb=15):
+    """
+    Smart tarike se image compress karna specific target size tak
+    """
+    result = _default_compressor.compress(img, target_kb)
+    return result.image, bytes(result.data), result.size_kb
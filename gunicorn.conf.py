@@ -0,0 +1,130 @@
+"""
+Production server profile for the image compressor.
+
+Run with:  gunicorn -c gunicorn.conf.py app:app
+
+Every value can be overridden from the environment, so the same file works
+on Render, in Docker and on a laptop.
+"""
+import gc
+import io
+import multiprocessing
+import os
+
+
+def _env_int(name, default):
+    """Read an integer setting from the environment"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _cpu_count():
+    """CPUs this process may actually run on (respects taskset/cgroup pinning)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def _memory_limit_mb():
+    """Smallest of the cgroup memory limit and MemAvailable, in MB (None if unknown)"""
+    limits = []
+
+    for path in ('/sys/fs/cgroup/memory.max',
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit():
+                limits.append(int(value) // (1024 * 1024))
+        except OSError:
+            pass
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    limits.append(int(line.split()[1]) // 1024)
+                    break
+    except OSError:
+        pass
+
+    return min(limits) if limits else None
+
+
+# A 5MB upload can decode to ~12 megapixels; RGB copy + resize + encode
+# buffers peak around this much per in-flight request.
+REQUEST_MEMORY_MB = _env_int('REQUEST_MEMORY_MB', 150)
+
+# Pillow releases the GIL while decoding, resizing and encoding, so a few
+# threads per worker overlap I/O with the CPU-bound work.
+threads = max(1, _env_int('GUNICORN_THREADS', 2))
+
+
+def _default_workers():
+    """One worker per CPU, capped by how many in-flight requests fit in memory"""
+    workers = _cpu_count()
+    memory_mb = _memory_limit_mb()
+    if memory_mb:
+        max_in_flight = max(1, memory_mb // REQUEST_MEMORY_MB)
+        workers = min(workers, max(1, max_in_flight // threads))
+    return max(1, workers)
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = _env_int('WEB_CONCURRENCY', _default_workers())
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# Import app.py (and Pillow) once in the master so workers share those pages
+preload_app = True
+
+# Recycle workers periodically so allocator fragmentation from large image
+# buffers can't grow without bound; jitter avoids all workers restarting at once
+max_requests = _env_int('MAX_REQUESTS', 500)
+max_requests_jitter = _env_int('MAX_REQUESTS_JITTER', max(1, max_requests // 10))
+
+timeout = _env_int('GUNICORN_TIMEOUT', 60)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-') or None
+loglevel = os.environ.get('GUNICORN_LOGLEVEL', 'info')
+
+
+def when_ready(server):
+    """Warm Pillow in the master before any worker is forked"""
+    from PIL import Image
+
+    # Register every format plugin and run one tiny encode per output format,
+    # so codec modules and lookup tables are loaded before the fork
+    Image.init()
+    sample = Image.new('RGB', (16, 16), (128, 128, 128))
+    for fmt in ('JPEG', 'PNG'):
+        sample.save(io.BytesIO(), fmt)
+
+    # Move everything allocated so far out of the GC's reach; otherwise the
+    # first collection in each worker touches (and copies) every shared page
+    gc.collect()
+    gc.freeze()
+
+    server.log.info("Preloaded Pillow codecs; %s workers x %s threads, recycle after %s requests",
+                    workers, threads, max_requests)
+
+
+def post_fork(server, worker):
+    """Start from the perceptual-hash index on disk, not the copy loaded at boot"""
+    from app import phash_index
+
+    # Recycled workers would otherwise never see what other workers merged since
+    if phash_index is not None:
+        phash_index.load()
+
+
+def worker_exit(server, worker):
+    """Merge the entries this worker added into the perceptual-hash index file"""
+    from app import phash_index
+
+    if phash_index is not None:
+        phash_index.save()
@@ -0,0 +1,203 @@
+"""
+Load test for the /compress endpoint.
+
+Hit a server that is already running:
+
+    python loadtest.py --url http://127.0.0.1:5000 --concurrency 8 --duration 20
+
+Or let the script start gunicorn once per configuration (WORKERSxTHREADS)
+and compare them side by side:
+
+    python loadtest.py --configs 1x1 2x2 4x2 --concurrency 8 --duration 20
+
+Every request comes from one IP with the same image, so servers started
+here run with rate limiting effectively off and the perceptual-hash index
+disabled; otherwise the numbers would measure throttling and result reuse,
+not capacity. Pass --with-limits to keep the server's own settings.
+Throttled responses (429/503) are counted apart from real errors.
+
+Only the standard library is used on the client side (http.client + threads).
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_multipart(image_path, target_kb):
+    """Build a multipart/form-data body once so every request reuses it"""
+    boundary = uuid.uuid4().hex
+    with open(image_path, 'rb') as f:
+        image_data = f.read()
+
+    parts = [
+        f'--{boundary}\r\n'.encode(),
+        b'Content-Disposition: form-data; name="target_size"\r\n\r\n',
+        f'{target_kb}\r\n'.encode(),
+        f'--{boundary}\r\n'.encode(),
+        f'Content-Disposition: form-data; name="image"; filename="{os.path.basename(image_path)}"\r\n'.encode(),
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        image_data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ]
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_load(url, body, content_type, concurrency, duration):
+    """Keep `concurrency` persistent connections busy for `duration` seconds"""
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    latencies = []
+    errors = [0]
+    throttled = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        conn = http.client.HTTPConnection(host, port, timeout=120)
+        local = []
+        local_errors = local_throttled = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request('POST', '/compress', body=body,
+                             headers={'Content-Type': content_type})
+                response = conn.getresponse()
+                response.read()
+                if response.status in (429, 503):
+                    local_throttled += 1
+                    continue
+                if response.status != 200:
+                    local_errors += 1
+                    continue
+                local.append(time.perf_counter() - start)
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=120)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+            throttled[0] += local_throttled
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throttled': throttled[0],
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+def wait_until_ready(url, timeout=30):
+    """Poll /readyz until the server answers 200"""
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=2)
+            conn.request('GET', '/readyz')
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.25)
+    return False
+
+
+# Server settings that take throttling and result reuse out of a capacity test
+UNLIMITED_ENV = {
+    'RATE_LIMIT_MPX_PER_SEC': '1000000',
+    'RATE_LIMIT_BURST_MPX': '1000000',
+    'COMPRESS_MAX_WAITING_PER_CLIENT': '1000',
+    'PHASH_INDEX': 'off',
+}
+
+
+def start_server(config, port, with_limits=False):
+    """Start gunicorn with a WORKERSxTHREADS configuration"""
+    workers, threads = config.lower().split('x')
+    env = dict(os.environ, WEB_CONCURRENCY=workers, GUNICORN_THREADS=threads,
+               PORT=str(port), GUNICORN_ACCESSLOG='')
+    if not with_limits:
+        env.update(UNLIMITED_ENV)
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def print_row(label, stats):
+    print(f"{label:<12} {stats['requests']:>8} {stats['throttled']:>9} {stats['errors']:>7} "
+          f"{stats['rps']:>8.1f} {stats['p50_ms']:>9.0f} {stats['p90_ms']:>9.0f} {stats['p99_ms']:>9.0f} {stats['max_ms']:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the /compress endpoint')
+    parser.add_argument('--url', default='http://127.0.0.1:5000',
+                        help='Server to test (ignored when --configs is given)')
+    parser.add_argument('--configs', nargs='*', default=[],
+                        help='gunicorn configurations to start and compare, e.g. 2x2 4x1')
+    parser.add_argument('--port', type=int, default=5055, help='Port used for --configs servers')
+    parser.add_argument('--image', default=os.path.join(HERE, 'image1.jpg'))
+    parser.add_argument('--target-size', type=int, default=15)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=15.0)
+    parser.add_argument('--with-limits', action='store_true',
+                        help='Keep rate limiting and the phash index on in --configs servers')
+    args = parser.parse_args()
+
+    body, content_type = build_multipart(args.image, args.target_size)
+
+    print(f"{'config':<12} {'requests':>8} {'throttled':>9} {'errors':>7} {'rps':>8} "
+          f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+
+    if not args.configs:
+        print_row('external', run_load(args.url, body, content_type,
+                                       args.concurrency, args.duration))
+        return
+
+    url = f'http://127.0.0.1:{args.port}'
+    for config in args.configs:
+        server = start_server(config, args.port, args.with_limits)
+        try:
+            if not wait_until_ready(url):
+                print(f"{config:<12} server did not become ready")
+                continue
+            print_row(config, run_load(url, body, content_type,
+                                       args.concurrency, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
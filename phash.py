@@ -0,0 +1,458 @@
+"""
+Perceptual-hash index of past compressions.
+
+The same photo keeps coming back re-saved by another app, with its EXIF
+stripped or as a slightly different JPEG re-encode; byte-exact caching
+misses all of those. Every compressed upload is fingerprinted on a tiny
+grayscale thumbnail with two 64-bit hashes:
+
+- dHash (brightness gradients on 9x8 pixels), scanned with XOR + popcount
+  over the whole index to find candidates;
+- pHash (signs of the low DCT frequencies of 32x32 pixels), used with the
+  aspect ratio and mean colour to confirm a candidate, so flat or
+  differently shaped images don't collide.
+
+The index is a set of parallel NumPy arrays (49 bytes per entry), a
+ring buffer once full, merged into a local .npz file shared by every
+worker on the host (see PerceptualIndex.save). A confirmed
+match at the same settings hands back the quality and encoder profile that
+were chosen, which seed the search. Perceptually close is not the same
+image, though: a blurred face or a blacked-out line barely moves either
+hash. So the earlier result's storage name is handed back for reuse only
+when the decoded pixels are identical (pixel_digest) and the same owner
+(client) uploaded it; one client must never be served bytes derived from
+another client's image.
+"""
+import collections
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows: saves are not serialized between processes
+    fcntl = None
+
+FORMAT_VERSION = 3
+
+DHASH_SIZE = 8
+PHASH_SIZE = 32
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis, so a 2-D DCT is two matrix products"""
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    basis = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    basis[0] /= np.sqrt(2.0)
+    return basis
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:  # NumPy < 2.0
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values):
+        values = np.ascontiguousarray(values, dtype=np.uint64)
+        return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def _pack(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+class ImageHash:
+    """Fingerprint of one image: two 64-bit hashes, aspect ratio and mean colour"""
+
+    __slots__ = ('dhash', 'phash', 'aspect', 'color')
+
+    def __init__(self, dhash, phash, aspect, color):
+        self.dhash = dhash
+        self.phash = phash
+        self.aspect = aspect
+        self.color = color
+
+
+def image_hash(source):
+    """
+    Fingerprint an image given as bytes or a PIL image.
+
+    From bytes, JPEGs are decoded at reduced scale (draft mode), which makes
+    hashing a large photo cost a few milliseconds. Pixels are hashed as
+    stored, without applying EXIF orientation, like the compressor encodes
+    them.
+    """
+    if isinstance(source, Image.Image):
+        img = source
+    else:
+        img = Image.open(io.BytesIO(source))
+        img.draft('RGB', (PHASH_SIZE * 2, PHASH_SIZE * 2))
+    aspect = img.width / img.height
+
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        img = img.convert('RGB')
+    thumb = img.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BOX, reducing_gap=2.0)
+    thumb = thumb.convert('RGB')
+    color = tuple(int(c) for c in np.asarray(thumb).reshape(-1, 3).mean(axis=0))
+
+    gray = thumb.convert('L')
+    small = np.asarray(gray.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BOX), dtype=np.int16)
+    dhash = _pack(small[:, 1:] > small[:, :-1])
+
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].ravel()
+    phash = _pack(low > np.median(low[1:]))  # The DC term would skew the median
+
+    return ImageHash(dhash, phash, aspect, color)
+
+
+def pixel_digest(img, band_rows=256):
+    """
+    64-bit digest of an image's decoded pixels (mode and size included).
+    Hashed a band of rows at a time, so no full copy of a large image is made.
+    """
+    digest = hashlib.blake2b(f'{img.mode} {img.width}x{img.height}'.encode(), digest_size=8)
+    for top in range(0, img.height, band_rows):
+        digest.update(img.crop((0, top, img.width, min(img.height, top + band_rows))).tobytes())
+    return int.from_bytes(digest.digest(), 'big') or 1  # 0 means "unknown" in the index
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Exclusive lock on `path` (created if missing) held for the block"""
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def params_key(*params):
+    """64-bit key for the settings a result depends on (target, crop, ...)"""
+    digest = hashlib.blake2b(repr(params).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class Match:
+    """A confirmed near-duplicate in the index"""
+
+    __slots__ = ('row', 'distance', 'reusable', 'name', 'quality', 'profile')
+
+    def __init__(self, row, distance, reusable, name, quality, profile):
+        self.row = row
+        self.distance = distance
+        self.reusable = reusable
+        self.name = name
+        self.quality = quality
+        self.profile = profile
+
+
+class PerceptualIndex:
+    """
+    Array-backed near-duplicate index.
+
+    A lookup is a linear XOR/popcount scan of the dHash column: a few
+    milliseconds at a million entries with no tree to rebalance, and the
+    arrays double as the on-disk format. Matches of the same owner within
+    `reuse_distance` bits and with the same pixel digest may reuse the
+    earlier result; any other match within `seed_distance` only seeds the
+    quality search.
+    """
+
+    _COLUMNS = {'dhash': np.uint64, 'phash': np.uint64, 'key': np.uint64, 'owner': np.uint64,
+                'pixels': np.uint64, 'aspect': np.float32, 'quality': np.uint8,
+                'profile': np.uint8}
+
+    def __init__(self, path=None, capacity=1000000, reuse_distance=6, seed_distance=10,
+                 phash_distance=8, save_every=500, max_names=20000):
+        self.path = path
+        self.capacity = capacity
+        self.reuse_distance = reuse_distance
+        self.seed_distance = seed_distance
+        self.phash_distance = phash_distance
+        self.save_every = save_every
+        self.max_names = max_names
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._columns = {name: np.zeros(0, dtype) for name, dtype in self._COLUMNS.items()}
+        self._color = np.zeros((0, 3), np.uint8)
+        self._count = 0
+        self._next = 0
+        self._profiles = []
+        # Storage names only matter while the results exist, so just the newest are kept
+        self._names = collections.OrderedDict()
+        self._pending = []  # Entries added here and not yet merged into `path`
+        self._save_wanted = threading.Event()
+        self._saver_pid = None
+        self._latencies = collections.deque(maxlen=1000)
+        self._metrics = {'lookups': 0, 'matches': 0, 'reusable': 0, 'adds': 0, 'saves': 0}
+        if path:
+            self.load()
+
+    def __len__(self):
+        return self._count
+
+    # Storage -------------------------------------------------------------
+
+    def _grow(self, size):
+        """Enlarge every column to hold `size` rows (lock held)"""
+        for name, column in self._columns.items():
+            grown = np.zeros(size, column.dtype)
+            grown[:self._count] = column[:self._count]
+            self._columns[name] = grown
+        color = np.zeros((size, 3), np.uint8)
+        color[:self._count] = self._color[:self._count]
+        self._color = color
+
+    def add(self, hashes, key, quality, profile, name=None, owner=0, pixels=0):
+        """
+        Record a finished compression; overwrites the oldest entry once full.
+        `quality` None records no usable quality (e.g. the image was downscaled).
+        `owner` is a 64-bit key of whoever uploaded it (see params_key) and
+        `pixels` the upload's pixel_digest (0 when unknown: never reusable).
+        """
+        entry = (hashes, key, quality, profile, name, owner, pixels)
+        with self._lock:
+            self._insert(entry)
+            if self.path:
+                self._pending.append(entry)
+            self._metrics['adds'] += 1
+            save = self.path and self.save_every and len(self._pending) >= self.save_every
+        if save:
+            # Writing tens of MB does not belong in the request that tipped the count
+            self._ensure_saver()
+            self._save_wanted.set()
+
+    def _insert(self, entry):
+        """Write one entry at the ring position (lock held)"""
+        hashes, key, quality, profile, name, owner, pixels = entry
+        row = self._next
+        if row >= len(self._color):
+            self._grow(min(self.capacity, max(1024, 2 * len(self._color))))
+        if profile not in self._profiles:
+            self._profiles.append(profile)
+
+        columns = self._columns
+        columns['dhash'][row] = hashes.dhash
+        columns['phash'][row] = hashes.phash
+        columns['key'][row] = np.uint64(key)
+        columns['owner'][row] = np.uint64(owner)
+        columns['pixels'][row] = np.uint64(pixels)
+        columns['aspect'][row] = hashes.aspect
+        columns['quality'][row] = quality or 0
+        columns['profile'][row] = self._profiles.index(profile)
+        self._color[row] = hashes.color
+
+        self._names.pop(row, None)
+        if name:
+            self._names[row] = name
+            if len(self._names) > self.max_names:
+                self._names.popitem(last=False)
+
+        self._count = max(self._count, row + 1)
+        self._next = (row + 1) % self.capacity
+
+    def lookup(self, hashes, key, owner=0, pixels=0):
+        """
+        Closest confirmed near-duplicate under the same settings, or None.
+        A match of the same `owner` with the same `pixels` digest is
+        preferred and is the only kind that is reusable or carries a name.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            n = self._count
+            columns = self._columns
+            distances = _popcount(columns['dhash'][:n] ^ np.uint64(hashes.dhash))
+            rows = np.flatnonzero(distances <= self.seed_distance)
+            rows = rows[columns['key'][rows] == np.uint64(key)]
+
+            match = None
+            if len(rows):
+                # Confirm candidates: same content by pHash, same shape, same overall colour
+                phash = _popcount(columns['phash'][rows] ^ np.uint64(hashes.phash))
+                aspect = np.abs(columns['aspect'][rows] / hashes.aspect - 1)
+                color = np.abs(self._color[rows].astype(np.int16) - hashes.color).max(axis=1)
+                ok = (phash <= self.phash_distance) & (aspect < 0.02) & (color <= 12)
+                if ok.any():
+                    score = distances[rows].astype(np.int32) + phash
+                    reusable = (ok & (distances[rows] <= self.reuse_distance)
+                                & (columns['owner'][rows] == np.uint64(owner))
+                                & (columns['pixels'][rows] == np.uint64(pixels)) & bool(pixels))
+                    pick = reusable if reusable.any() else ok
+                    best = int(rows[pick][np.argmin(score[pick])])
+                    match = Match(best, int(distances[best]), bool(reusable.any()),
+                                  self._names.get(best) if reusable.any() else None,
+                                  int(columns['quality'][best]) or None,
+                                  self._profiles[columns['profile'][best]])
+
+            self._latencies.append(time.perf_counter() - start)
+            self._metrics['lookups'] += 1
+            if match is not None:
+                self._metrics['matches'] += 1
+                self._metrics['reusable'] += match.reusable
+        return match
+
+    # Persistence ---------------------------------------------------------
+
+    def _ensure_saver(self):
+        """Start the background saver in this process (threads don't survive fork)"""
+        if self._saver_pid == os.getpid():
+            return
+        with self._lock:
+            if self._saver_pid == os.getpid():
+                return
+            self._saver_pid = os.getpid()
+        thread = threading.Thread(target=self._save_loop, name='phash-index-saver', daemon=True)
+        thread.start()
+
+    def _save_loop(self):
+        while True:
+            self._save_wanted.wait()
+            self._save_wanted.clear()
+            try:
+                self.save()
+            except Exception as e:
+                print(f"Could not save perceptual-hash index {self.path}: {e}")
+
+    def save(self):
+        """
+        Merge the entries added here since the last save into `path`.
+
+        Every process sharing the file (one per gunicorn worker) appends its
+        own new entries to what is on disk, under an exclusive file lock, and
+        then adopts the merged index, so workers also pick up each other's
+        entries. Does nothing when nothing was added, so a process that only
+        read the index never writes it.
+        """
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                entries, self._pending = self._pending, []
+            if not entries:
+                return
+            try:
+                with _file_lock(self.path + '.lock'):
+                    merged = PerceptualIndex(self.path, capacity=self.capacity, save_every=0,
+                                             max_names=self.max_names)
+                    for entry in entries:
+                        merged._insert(entry)
+                    merged._write()
+            except BaseException:
+                with self._lock:
+                    self._pending[:0] = entries  # Retry them with the next save
+                raise
+
+            with self._lock:
+                # Entries added while merging are still pending; keep them on top
+                added_meanwhile = self._pending
+                self._adopt(merged)
+                for entry in added_meanwhile:
+                    self._insert(entry)
+                self._metrics['saves'] += 1
+
+    def _adopt(self, other):
+        """Take over another index's contents (lock held)"""
+        self._columns = other._columns
+        self._color = other._color
+        self._count = other._count
+        self._next = other._next
+        self._profiles = other._profiles
+        self._names = other._names
+
+    def _write(self):
+        """Atomically replace `path` with this index"""
+        with self._lock:
+            n = self._count
+            arrays = {name: column[:n] for name, column in self._columns.items()}
+            arrays['color'] = self._color[:n]
+            arrays['meta'] = np.array([FORMAT_VERSION, self._next, self.capacity], np.int64)
+            arrays['profiles'] = np.array(self._profiles, dtype=str)
+            arrays['name_rows'] = np.array(list(self._names), dtype=np.int64)
+            arrays['names'] = np.array(list(self._names.values()), dtype=str)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def load(self):
+        """
+        Replace the contents with `path` if it exists (gunicorn workers call
+        this after fork); an unreadable file leaves the index as it is.
+        """
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                version, next_row, capacity = (int(v) for v in data['meta'])
+                if version != FORMAT_VERSION or capacity != self.capacity:
+                    print(f"Ignoring perceptual-hash index {self.path}: written with other settings")
+                    return
+                arrays = {name: data[name] for name in list(self._COLUMNS) + ['color']}
+                profiles = [str(p) for p in data['profiles']]
+                names = zip(data['name_rows'].tolist(), data['names'].tolist())
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Could not load perceptual-hash index {self.path}: {e}")
+            return
+
+        with self._lock:
+            self._count = len(arrays['dhash'])
+            self._next = next_row
+            self._color = arrays.pop('color')
+            self._columns = {name: array.astype(self._COLUMNS[name]) for name, array in arrays.items()}
+            self._profiles = profiles
+            self._names = collections.OrderedDict(names)
+            # Entries not yet merged into the file stay in memory too
+            for entry in self._pending:
+                self._insert(entry)
+
+    # Reporting -----------------------------------------------------------
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            latencies = sorted(self._latencies)
+            metrics.update(entries=self._count, capacity=self.capacity, pending=len(self._pending),
+                           bytes=sum(c.nbytes for c in self._columns.values()) + self._color.nbytes)
+        lookups = metrics['lookups']
+        metrics['hit_rate'] = round(metrics['matches'] / lookups, 3) if lookups else None
+        metrics['reuse_rate'] = round(metrics['reusable'] / lookups, 3) if lookups else None
+        if latencies:
+            metrics['lookup_ms_p50'] = round(latencies[len(latencies) // 2] * 1000, 3)
+            metrics['lookup_ms_p99'] = round(latencies[int(len(latencies) * 0.99)] * 1000, 3)
+        return metrics
+
+
+def index_from_env(default_path):
+    """Build a PerceptualIndex from PHASH_* environment variables (None when disabled)"""
+    if os.environ.get('PHASH_INDEX', 'on').lower() in ('0', 'off', 'false', 'no'):
+        return None
+    return PerceptualIndex(
+        path=os.environ.get('PHASH_INDEX_PATH', default_path),
+        capacity=int(os.environ.get('PHASH_CAPACITY', 1000000)),
+        reuse_distance=int(os.environ.get('PHASH_REUSE_DISTANCE', 6)),
+        seed_distance=int(os.environ.get('PHASH_SEED_DISTANCE', 10)),
+        save_every=int(os.environ.get('PHASH_SAVE_EVERY', 500)),
+    )
@@ -0,0 +1,147 @@
+"""
+On-demand sampling profiler and slow-request capture.
+
+SamplingProfiler snapshots every thread's Python stack from the thread that
+asked for the profile, at a fixed interval (sys._current_frames), so the
+profiled code runs unmodified and the cost is one stack walk per thread per
+tick. Results come back as collapsed stacks ("outer;inner;leaf count" per
+line), the input format of flamegraph.pl and speedscope.
+
+SlowRequestLog keeps the last N requests that exceeded a latency threshold,
+with per-stage timings and the input characteristics, in a bounded ring
+buffer.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ProfilerBusy(Exception):
+    """A profiling session is already running in this process"""
+
+
+class SamplingProfiler:
+    """Statistical profiler over all (or only request-handling) threads"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._session = threading.Lock()
+        self._lock = threading.Lock()
+        self._active_requests = set()
+        self._requests_left = None
+        self._requests_done = threading.Event()
+
+    # Request hooks -------------------------------------------------------
+
+    def request_started(self):
+        with self._lock:
+            self._active_requests.add(threading.get_ident())
+
+    def request_finished(self):
+        with self._lock:
+            self._active_requests.discard(threading.get_ident())
+            if self._requests_left is not None:
+                self._requests_left -= 1
+                if self._requests_left <= 0:
+                    self._requests_done.set()
+
+    # Sampling ------------------------------------------------------------
+
+    @staticmethod
+    def _collapse(frame):
+        """Render a stack root-first as 'func (file:line);...'"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _sample_until(self, done, requests_only, exclude):
+        counts = collections.Counter()
+        samples = 0
+        while not done():
+            with self._lock:
+                wanted = set(self._active_requests) if requests_only else None
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in exclude or (wanted is not None and thread_id not in wanted):
+                    continue
+                counts[self._collapse(frame)] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return counts, samples
+
+    def profile(self, seconds=None, requests=None, timeout=120):
+        """
+        Sample for `seconds`, or until `requests` more requests finish (only
+        request-handling threads are sampled then). Returns (collapsed_text, info).
+        """
+        if not self._session.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            exclude = {threading.get_ident()}  # The thread serving the profile request
+            start = time.monotonic()
+            if requests:
+                with self._lock:
+                    self._requests_left = requests
+                    self._requests_done.clear()
+                deadline = start + timeout
+                done = lambda: self._requests_done.is_set() or time.monotonic() > deadline
+            else:
+                deadline = start + seconds
+                done = lambda: time.monotonic() > deadline
+
+            counts, samples = self._sample_until(done, bool(requests), exclude)
+        finally:
+            with self._lock:
+                self._requests_left = None
+            self._session.release()
+
+        lines = [f"{stack} {count}" for stack, count in counts.most_common()]
+        info = {'samples': samples, 'seconds': round(time.monotonic() - start, 3),
+                'interval_ms': self.interval * 1000, 'stacks': len(lines), 'pid': os.getpid()}
+        return '\n'.join(lines) + '\n', info
+
+
+class StageTimer:
+    """Accumulates named stage durations (ms) and facts about one request"""
+
+    def __init__(self):
+        self.stages = {}
+        self.info = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.stages[name] = round(self.stages.get(name, 0.0) + elapsed, 2)
+
+
+class SlowRequestLog:
+    """Bounded ring buffer of requests slower than `threshold_ms`"""
+
+    def __init__(self, threshold_ms=2000, capacity=200):
+        self.threshold_ms = threshold_ms
+        self._records = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self.captured = 0
+
+    def observe(self, elapsed_ms, record):
+        """Keep `record` if the request took longer than the threshold"""
+        if elapsed_ms < self.threshold_ms:
+            return False
+        record = dict(record, elapsed_ms=round(elapsed_ms, 2), time=time.time(), pid=os.getpid())
+        with self._lock:
+            self._records.append(record)
+            self.captured += 1
+        return True
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
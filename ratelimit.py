@@ -0,0 +1,315 @@
+"""
+Per-client rate limiting and fair scheduling for /compress.
+
+Requests are charged by their estimated cost (decoded megapixels) rather
+than counted, so one 12 MP upload costs as much as a dozen thumbnails. A
+token bucket per client (a configured API key, else the IP) refills at a
+steady rate; buckets
+live in-process by default, or in a local SQLite file so every gunicorn
+worker on the host shares them.
+
+Admitted requests then pass through a FairScheduler, which hands the
+limited compression slots out round-robin across clients instead of in
+arrival order.
+"""
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+class Decision:
+    """Outcome of a rate-limit check"""
+
+    def __init__(self, allowed, remaining, retry_after=0.0):
+        self.allowed = allowed
+        self.remaining = remaining
+        self.retry_after = retry_after
+
+
+class MemoryBackend:
+    """Token buckets in a dict; private to one process"""
+
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, rate, capacity, now):
+        """Refill `key`'s bucket, try to take `cost`, return (allowed, tokens left)"""
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self.max_clients:
+                self._prune(rate, capacity, now)
+            return allowed, tokens
+
+    def _prune(self, rate, capacity, now):
+        """Forget clients whose buckets have refilled completely"""
+        full_after = capacity / rate if rate else float('inf')
+        for key, (_, updated) in list(self._buckets.items()):
+            if now - updated >= full_after:
+                del self._buckets[key]
+
+
+class SQLiteBackend:
+    """Token buckets in a local SQLite file, shared by every process on the host"""
+
+    def __init__(self, path, prune_interval=300):
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._last_prune = 0.0
+        # Short-lived: this may run in gunicorn's preloading master before fork
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets '
+                         '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        """
+        One connection per thread and process: sqlite3 connections are not
+        thread-safe, and must not be used across fork().
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, cost, rate, capacity, now):
+        """Refill `key`'s bucket, try to take `cost`, return (allowed, tokens left)"""
+        conn = self._connect()
+        # IMMEDIATE takes the write lock up front, making read-modify-write atomic
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+
+            if now - self._last_prune > self.prune_interval and rate:
+                self._last_prune = now
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - capacity / rate,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+
+class RateLimiter:
+    """
+    Cost-weighted token bucket per client.
+
+    `rate` is cost units (megapixels) refilled per second and `capacity` the
+    burst a client can spend at once.
+    """
+
+    def __init__(self, rate=2.0, capacity=40.0, backend=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.backend = backend or MemoryBackend()
+        self._lock = threading.Lock()
+        self._metrics = {'allowed': 0, 'throttled': 0, 'allowed_cost': 0.0,
+                         'throttled_cost': 0.0, 'backend_errors': 0}
+
+    def check(self, key, cost):
+        """Charge `cost` to `key`; a request costing more than the burst is capped to it"""
+        cost = min(cost, self.capacity)
+        try:
+            allowed, tokens = self.backend.take(key, cost, self.rate, self.capacity, time.time())
+        except sqlite3.Error as e:
+            # A limiter outage must not take the service down with it
+            print(f"Rate limiter backend error: {e}")
+            with self._lock:
+                self._metrics['backend_errors'] += 1
+            return Decision(True, self.capacity)
+
+        with self._lock:
+            if allowed:
+                self._metrics['allowed'] += 1
+                self._metrics['allowed_cost'] += cost
+            else:
+                self._metrics['throttled'] += 1
+                self._metrics['throttled_cost'] += cost
+
+        if allowed:
+            return Decision(True, tokens)
+        retry_after = (cost - tokens) / self.rate if self.rate else float('inf')
+        return Decision(False, tokens, retry_after)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['allowed_cost'] = round(metrics['allowed_cost'], 2)
+        metrics['throttled_cost'] = round(metrics['throttled_cost'], 2)
+        metrics.update(rate=self.rate, capacity=self.capacity,
+                       backend=type(self.backend).__name__)
+        return metrics
+
+
+class QueueFull(Exception):
+    """The client already has too many requests waiting"""
+
+
+class QueueTimeout(Exception):
+    """No compression slot became free in time"""
+
+
+class _Ticket:
+    __slots__ = ('granted',)
+
+    def __init__(self):
+        self.granted = False
+
+
+class FairScheduler:
+    """
+    Admit at most `slots` compressions at once, round-robin across clients.
+
+    Each client has its own FIFO of waiting requests; whenever a slot frees
+    up it goes to the head of the next client in rotation, so a client with
+    a hundred queued uploads only gets every other turn against a client
+    with one.
+    """
+
+    def __init__(self, slots=1, max_waiting_per_client=8, timeout=30.0):
+        self.slots = slots
+        self.max_waiting_per_client = max_waiting_per_client
+        self.timeout = timeout
+        self._free = slots
+        self._queues = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._metrics = {'admitted': 0, 'rejected_full': 0, 'timeouts': 0,
+                         'waited': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def _dispatch(self):
+        """Grant free slots to waiting clients in rotation (lock held)"""
+        while self._free and self._queues:
+            key, queue = self._queues.popitem(last=False)
+            queue.popleft().granted = True
+            self._free -= 1
+            if queue:
+                self._queues[key] = queue  # Back of the rotation
+        self._cond.notify_all()
+
+    def acquire(self, key):
+        """Wait for a slot on behalf of `key`"""
+        start = time.monotonic()
+        with self._cond:
+            queue = self._queues.get(key)
+            if queue is not None and len(queue) >= self.max_waiting_per_client:
+                self._metrics['rejected_full'] += 1
+                raise QueueFull(key)
+
+            ticket = _Ticket()
+            if queue is None:
+                queue = self._queues[key] = collections.deque()
+            queue.append(ticket)
+            self._dispatch()
+
+            if not self._cond.wait_for(lambda: ticket.granted, self.timeout):
+                queue.remove(ticket)
+                if not queue and self._queues.get(key) is queue:
+                    del self._queues[key]
+                self._metrics['timeouts'] += 1
+                raise QueueTimeout(key)
+
+            waited = time.monotonic() - start
+            self._metrics['admitted'] += 1
+            if waited > 0.001:
+                self._metrics['waited'] += 1
+            self._metrics['wait_seconds'] += waited
+            self._metrics['max_wait_seconds'] = max(self._metrics['max_wait_seconds'], waited)
+
+    def release(self):
+        with self._cond:
+            self._free += 1
+            self._dispatch()
+
+    def slot(self, key):
+        """Context manager holding one compression slot for `key`"""
+        return _Slot(self, key)
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics['waiting'] = sum(len(q) for q in self._queues.values())
+            metrics['waiting_clients'] = len(self._queues)
+            metrics['busy_slots'] = self.slots - self._free
+        metrics['slots'] = self.slots
+        metrics['wait_seconds'] = round(metrics['wait_seconds'], 3)
+        metrics['max_wait_seconds'] = round(metrics['max_wait_seconds'], 3)
+        return metrics
+
+
+class _Slot:
+    def __init__(self, scheduler, key):
+        self.scheduler = scheduler
+        self.key = key
+
+    def __enter__(self):
+        self.scheduler.acquire(self.key)
+        return self
+
+    def __exit__(self, *exc):
+        self.scheduler.release()
+        return False
+
+
+def api_key_digest(api_key):
+    """SHA-256 hex digest of an API key; only digests are kept in memory and buckets"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def api_keys_from_env():
+    """
+    Digests of the API keys that get a bucket of their own, from
+    RATE_LIMIT_API_KEYS (comma-separated keys) and RATE_LIMIT_API_KEYS_FILE
+    (one SHA-256 hex digest per line). Empty when neither is set.
+    """
+    digests = {api_key_digest(key.strip())
+               for key in os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key.strip()}
+    path = os.environ.get('RATE_LIMIT_API_KEYS_FILE')
+    if path:
+        with open(path) as f:
+            digests.update(line.strip().lower() for line in f
+                           if line.strip() and not line.startswith('#'))
+    return frozenset(digests)
+
+
+def limiter_from_env(default_db_path):
+    """Build a RateLimiter from RATE_LIMIT_* environment variables"""
+    rate = float(os.environ.get('RATE_LIMIT_MPX_PER_SEC', 2.0))
+    capacity = float(os.environ.get('RATE_LIMIT_BURST_MPX', 40.0))
+    if os.environ.get('RATE_LIMIT_BACKEND', 'memory').lower() == 'sqlite':
+        path = os.environ.get('RATE_LIMIT_DB', default_db_path)
+        backend = SQLiteBackend(path)
+    else:
+        backend = MemoryBackend()
+    return RateLimiter(rate, capacity, backend)
+
+
+def scheduler_from_env():
+    """Build a FairScheduler from COMPRESS_* environment variables"""
+    return FairScheduler(
+        slots=int(os.environ.get('COMPRESS_SLOTS', 1)),
+        max_waiting_per_client=int(os.environ.get('COMPRESS_MAX_WAITING_PER_CLIENT', 8)),
+        timeout=float(os.environ.get('COMPRESS_QUEUE_TIMEOUT', 30)),
+    )
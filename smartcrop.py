@@ -0,0 +1,128 @@
+"""
+Saliency-guided cropping.
+
+For tiny budgets it is better to encode fewer pixels around the subject than
+to shrink the whole frame until faces and products are unrecognizable. The
+saliency map is computed on a small thumbnail with vectorized NumPy, and the
+best crop window is found with an integral image, so the cost is independent
+of the input resolution.
+"""
+import numpy as np
+from PIL import Image
+
+THUMBNAIL_SIZE = 128
+
+
+def parse_aspect(value):
+    """Parse '16:9', '1.5' or a number into a width/height ratio (None for off)"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ('none', 'off', 'original'):
+            return None
+        if ':' in value:
+            width, height = value.split(':', 1)
+            try:
+                aspect = float(width) / float(height)
+            except ZeroDivisionError:
+                raise ValueError(f'crop aspect ratio out of range: {value}') from None
+        else:
+            aspect = float(value)
+    else:
+        aspect = float(value)
+    if not (0.1 <= aspect <= 10):
+        raise ValueError(f'crop aspect ratio out of range: {value}')
+    return aspect
+
+
+def _box_blur(values, radius):
+    """Mean filter of (2*radius+1)^2 using a summed-area table"""
+    if radius < 1:
+        return values
+    padded = np.pad(values, radius + 1, mode='edge')
+    table = padded.cumsum(0).cumsum(1)
+    size = 2 * radius + 1
+    window = (table[size:, size:] - table[:-size, size:]
+              - table[size:, :-size] + table[:-size, :-size])
+    return window[:values.shape[0], :values.shape[1]] / (size * size)
+
+
+def saliency_map(img, size=THUMBNAIL_SIZE):
+    """
+    Per-pixel saliency of a thumbnail of `img`, normalised to 0..1.
+
+    Combines edge energy (where the detail is) with colour distinctiveness
+    (pixels far from the mean colour), smoothed so regions win over noise,
+    and weighted by a mild centre prior to break ties.
+    """
+    scale = size / max(img.size)
+    thumb_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    thumb = img.convert('RGB') if img.mode != 'RGB' else img
+    thumb = thumb.resize(thumb_size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+    rgb = np.asarray(thumb, dtype=np.float32) / 255.0
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    edges = np.zeros_like(gray)
+    edges[:, 1:] += np.abs(np.diff(gray, axis=1))
+    edges[1:, :] += np.abs(np.diff(gray, axis=0))
+
+    distinct = np.sqrt(((rgb - rgb.reshape(-1, 3).mean(axis=0)) ** 2).sum(axis=2))
+
+    radius = max(1, size // 32)
+    saliency = (_box_blur(edges / (edges.max() or 1), radius)
+                + 0.5 * _box_blur(distinct / (distinct.max() or 1), radius))
+
+    ys = np.linspace(-1, 1, gray.shape[0], dtype=np.float32)[:, None]
+    xs = np.linspace(-1, 1, gray.shape[1], dtype=np.float32)[None, :]
+    saliency *= 1.0 - 0.3 * (xs * xs + ys * ys) / 2
+
+    return saliency / (saliency.max() or 1)
+
+
+def find_crop_box(img, aspect, zoom=1.0, size=THUMBNAIL_SIZE):
+    """
+    Return the (left, upper, right, lower) box of `img` with the given
+    width/height ratio that holds the most saliency.
+
+    zoom=1 uses the largest window of that aspect; zoom=2 a window half as
+    wide and high, for a tighter crop around the subject.
+    """
+    saliency = saliency_map(img, size)
+    thumb_h, thumb_w = saliency.shape
+
+    # Largest window of the requested aspect that fits the thumbnail
+    window_w = min(thumb_w, thumb_h * aspect) / max(zoom, 1.0)
+    window_h = window_w / aspect
+    win_w = max(1, min(thumb_w, int(round(window_w))))
+    win_h = max(1, min(thumb_h, int(round(window_h))))
+
+    # Sum of saliency under every window position, in one vectorized pass
+    table = np.zeros((thumb_h + 1, thumb_w + 1), dtype=np.float64)
+    table[1:, 1:] = saliency.cumsum(0).cumsum(1)
+    sums = (table[win_h:, win_w:] - table[:-win_h, win_w:]
+            - table[win_h:, :-win_w] + table[:-win_h, :-win_w])
+    top, left = np.unravel_index(np.argmax(sums), sums.shape)
+
+    # Map the thumbnail window back onto the full image, keeping the exact aspect
+    scale_x = img.width / thumb_w
+    scale_y = img.height / thumb_h
+    center_x = (left + win_w / 2) * scale_x
+    center_y = (top + win_h / 2) * scale_y
+
+    crop_w = min(img.width, img.height * aspect) / max(zoom, 1.0)
+    crop_h = crop_w / aspect
+    crop_w, crop_h = max(1, int(round(crop_w))), max(1, int(round(crop_h)))
+
+    x0 = int(round(min(max(center_x - crop_w / 2, 0), img.width - crop_w)))
+    y0 = int(round(min(max(center_y - crop_h / 2, 0), img.height - crop_h)))
+    return (x0, y0, x0 + crop_w, y0 + crop_h)
+
+
+def smart_crop(img, aspect, zoom=1.0):
+    """Crop `img` to `aspect` (width/height) around its most salient region"""
+    box = find_crop_box(img, aspect, zoom)
+    if box == (0, 0, img.width, img.height):
+        return img
+    return img.crop(box)
@@ -0,0 +1,227 @@
+"""
+Bounded on-disk storage for compressed results and other temp files.
+
+Entries are tracked with their size and last-access time and are evicted
+by a background sweeper once they outlive the TTL, or oldest-first when the
+directory grows past its byte quota. Files are written to a hidden temp
+name and renamed into place, so a reader (in any worker) sees either the
+whole file or nothing.
+
+Last access is kept in the file's mtime, which lets every gunicorn worker
+sharing the directory agree on what is stale without extra coordination.
+"""
+import os
+import re
+import tempfile
+import threading
+import time
+
+TEMP_PREFIX = '.tmp-'
+VALID_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$')
+
+
+class TempStorage:
+    """TTL- and quota-bounded directory of named files"""
+
+    def __init__(self, root, ttl=3600, max_bytes=200 * 1024 * 1024, sweep_interval=60):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._entries = {}  # name -> [size, last_access]
+        self._total = 0
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+        self._stats = {'writes': 0, 'evicted_ttl': 0, 'evicted_quota': 0,
+                       'sweeps': 0, 'last_sweep': None}
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def valid_name(name):
+        return bool(name) and VALID_NAME.match(name) is not None
+
+    def _path(self, name):
+        if not self.valid_name(name):
+            raise ValueError(f'invalid storage name: {name!r}')
+        return os.path.join(self.root, name)
+
+    def _ensure_sweeper(self):
+        """Start the sweeper thread in this process (threads don't survive fork)"""
+        if self._sweeper_pid == os.getpid() or not self.sweep_interval:
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        thread = threading.Thread(target=self._sweep_loop, name='temp-storage-sweeper', daemon=True)
+        thread.start()
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Temp storage sweep failed: {e}")
+            time.sleep(self.sweep_interval)
+
+    def put(self, name, data):
+        """Atomically write `data` (bytes-like) under `name` and return the path"""
+        self._ensure_sweeper()
+        path = self._path(name)
+
+        fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.root)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        size = memoryview(data).nbytes
+        with self._lock:
+            old = self._entries.get(name)
+            if old:
+                self._total -= old[0]
+            self._entries[name] = [size, time.time()]
+            self._total += size
+            self._stats['writes'] += 1
+            over_quota = self._total > self.max_bytes
+
+        if over_quota:
+            self._evict_over_quota()
+        return path
+
+    def path(self, name):
+        """Path of an existing entry, marking it as accessed (None if missing/evicted)"""
+        self._ensure_sweeper()
+        path = self._path(name)
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry:
+                entry[1] = now
+            else:
+                # Written by another worker; adopt it into this index
+                self._entries[name] = [size, now]
+                self._total += size
+        return path
+
+    def open(self, name):
+        """Open an entry for reading; the handle stays valid even if it is evicted later"""
+        path = self.path(name)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        """Remove an entry; returns True if it existed"""
+        path = self._path(name)
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry:
+                self._total -= entry[0]
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _evict(self, name, reason):
+        if self.delete(name):
+            with self._lock:
+                self._stats[reason] += 1
+
+    def _evict_over_quota(self):
+        """Drop least recently used entries until the directory fits the quota"""
+        with self._lock:
+            if self._total <= self.max_bytes:
+                return
+            oldest_first = sorted(self._entries.items(), key=lambda item: item[1][1])
+            excess = self._total - self.max_bytes
+            victims = []
+            for name, (size, _) in oldest_first:
+                if excess <= 0:
+                    break
+                victims.append(name)
+                excess -= size
+        for name in victims:
+            self._evict(name, 'evicted_quota')
+
+    def sweep(self):
+        """
+        Rescan the directory (picking up other workers' files), evict entries
+        past the TTL, then enforce the byte quota. Returns the number evicted.
+        """
+        now = time.time()
+        entries = {}
+        stale_temp = []
+        with os.scandir(self.root) as it:
+            for item in it:
+                try:
+                    if not item.is_file(follow_symlinks=False):
+                        continue
+                    st = item.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if item.name.startswith(TEMP_PREFIX):
+                    # Leftovers of writers that died mid-write
+                    if now - st.st_mtime > 600:
+                        stale_temp.append(item.path)
+                elif self.valid_name(item.name):
+                    entries[item.name] = [st.st_size, st.st_mtime]
+
+        for path in stale_temp:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        expired = [name for name, (_, accessed) in entries.items() if now - accessed > self.ttl]
+        with self._lock:
+            for name, entry in entries.items():
+                # Keep the fresher access time this process may have recorded
+                known = self._entries.get(name)
+                if known and known[1] > entry[1]:
+                    entry[1] = known[1]
+            self._entries = entries
+            self._total = sum(size for size, _ in entries.values())
+            self._stats['sweeps'] += 1
+            self._stats['last_sweep'] = now
+
+        before = self._stats['evicted_ttl'] + self._stats['evicted_quota']
+        for name in expired:
+            if now - self._entries.get(name, [0, now])[1] > self.ttl:
+                self._evict(name, 'evicted_ttl')
+        self._evict_over_quota()
+        return self._stats['evicted_ttl'] + self._stats['evicted_quota'] - before
+
+    def usage(self):
+        """Disk usage and eviction counters as seen by this process"""
+        with self._lock:
+            usage = dict(self._stats)
+            usage.update(files=len(self._entries), bytes=self._total,
+                         max_bytes=self.max_bytes, ttl_seconds=self.ttl)
+        return usage
+
+
+def storage_from_env(root):
+    """Build a TempStorage from STORAGE_* environment variables"""
+    return TempStorage(
+        root,
+        ttl=float(os.environ.get('STORAGE_TTL_SECONDS', 3600)),
+        max_bytes=int(float(os.environ.get('STORAGE_MAX_MB', 200)) * 1024 * 1024),
+        sweep_interval=float(os.environ.get('STORAGE_SWEEP_INTERVAL', 60)),
+    )